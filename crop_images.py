@@ -1,81 +1,57 @@
 import argparse
 import os
 import random
+import warnings
+from contextlib import contextmanager
+from multiprocessing import Pool
 from PIL import Image
-import re
-import torch
 import numpy as np
 
 # Remove PIL image size limit to handle large satellite images
 Image.MAX_IMAGE_PIXELS = None
 
-def get_random_bounding_box(size, res):
-    """
-    Generate a random bounding box.
-    
-    Args:
-    size: Tuple of (height, width) of the image
-    res: Tuple of (height, width) of the desired crop size
-    
-    Returns:
-    Tuple of (minx, maxx, miny, maxy) in normalized coordinates
-    """
-    height, width = size
-    res_height, res_width = res
-    
-    max_x = width - res_width
-    max_y = height - res_height
-    
-    x = random.randint(0, max(0, max_x))
-    y = random.randint(0, max(0, max_y))
-    
-    minx, maxx = x / width, (x + res_width) / width
-    miny, maxy = y / height, (y + res_height) / height
-    
-    return (minx, maxx, miny, maxy)
+# Formats read through rasterio windows instead of being fully decoded by PIL
+WINDOWED_EXTENSIONS = ('.tif', '.tiff')
 
-def bbox_to_yx_np(bbox, size):
+# Fixed-quality baseline JPEG: 4:2:0 subsampling, no optimization or progressive passes
+JPEG_SAVE_OPTIONS = {'quality': 90, 'subsampling': 2, 'optimize': False, 'progressive': False}
+
+def get_candidate_offsets(size, crop_size, stride=None):
     """
-    Convert a bounding box from normalized coordinates to pixel coordinates.
+    Generate every crop position on a regular grid, in random order.
     
     Args:
-    bbox: Tuple of (minx, maxx, miny, maxy) in normalized coordinates
     size: Tuple of (height, width) of the image
+    crop_size: Size of the square crop
+    stride: Grid spacing in pixels, defaults to half the crop size
     
     Returns:
-    Tuple of (top, left, bottom, right) in pixel coordinates
+    Shuffled list of (top, left) pixel coordinates
     """
     height, width = size
-    minx, maxx, miny, maxy = bbox
-    return (
-        int(miny * height),
-        int(minx * width),
-        int(maxy * height),
-        int(maxx * width)
-    )
+    stride = stride or max(1, crop_size // 2)
+    
+    candidates = [(y, x)
+                  for y in range(0, max(1, height - crop_size + 1), stride)
+                  for x in range(0, max(1, width - crop_size + 1), stride)]
+    random.shuffle(candidates)
+    return candidates
 
 def get_image_pairs(disaster_folder, location_folder):
     """
     Find and return pairs of before/after images for a specific disaster and location.
     """
     base_path = os.path.join('images', disaster_folder, location_folder)
-    files = os.listdir(base_path)
-    
-    # Sort files by date
-    dated_files = []
-    for file in files:
-        # Use regex to extract date from filename
-        match = re.match(r'(\d{4}-\d{2}-\d{2})_(.+)', file)
-        if match:
-            date_str, _ = match.groups()
-            dated_files.append((date_str, file))
     
-    dated_files.sort(key=lambda x: x[0])  # Sort by date string
+    # Filenames start with a YYYY-MM-DD date, so plain string order is chronological
+    with os.scandir(base_path) as entries:
+        dated_files = [entry.name for entry in entries
+                       if len(entry.name) > 11 and entry.name[4] == '-' and entry.name[7] == '-' and entry.name[10] == '_']
     
     # Find pair of images (before and after)
     if len(dated_files) >= 2:
-        before_file = dated_files[0][1]  # Earliest date
-        after_file = dated_files[-1][1]  # Latest date
+        before_file = min(dated_files)  # Earliest date
+        after_file = max(dated_files)  # Latest date
         return [(os.path.join(base_path, before_file),
                  os.path.join(base_path, after_file))]
     
@@ -85,31 +61,74 @@ def get_next_pair_number(output_base):
     """
     Determine the next available pair number for naming the output folder.
     """
-    existing_pairs = [d for d in os.listdir(output_base) if d.startswith('pair_') and os.path.isdir(os.path.join(output_base, d))]
-    if not existing_pairs:
-        return 1
-    pair_numbers = [int(d.split('_')[1]) for d in existing_pairs]
-    return max(pair_numbers) + 1
+    with os.scandir(output_base) as entries:
+        # Ignore pair_* folders without a numeric suffix, such as pair_1_old
+        pair_numbers = [int(entry.name[len('pair_'):]) for entry in entries
+                        if entry.name.startswith('pair_') and entry.name[len('pair_'):].isdecimal()
+                        and entry.is_dir(follow_symlinks=False)]
+    return max(pair_numbers, default=0) + 1
 
-def is_valid_crop(image, bbox, threshold=0.01):
+def is_valid_crop(crop_array, threshold=0.01):
     """
     Check if the crop is not mostly black.
     
     Args:
-    image: PIL Image object
-    bbox: Tuple of (left, top, right, bottom)
+    crop_array: uint8 NumPy array of the crop (a view into the full image array)
     threshold: Minimum proportion of non-black pixels required
     
     Returns:
     Boolean indicating if the crop is valid
     """
-    crop = image.crop(bbox)
-    crop_array = torch.tensor(np.array(crop)).float() / 255
-    non_black_pixels = torch.sum(crop_array > 0.1)  # Count pixels brighter than 10% intensity
-    total_pixels = crop_array.numel() / 3  # Divide by 3 for RGB channels
-    return (non_black_pixels / total_pixels) > threshold
+    # A pixel is non-black if its brightest channel is above 10% intensity
+    non_black_pixels = np.count_nonzero(crop_array.max(axis=-1) > 25)
+    return (non_black_pixels / (crop_array.shape[0] * crop_array.shape[1])) > threshold
+
+@contextmanager
+def open_crop_reader(path):
+    """
+    Open an image for reading square crops from it.
+    
+    GeoTIFFs (such as COGs) are read through rasterio windows, so only the internal tiles
+    overlapping a crop are decoded. Other formats are decoded once with PIL and sliced.
+    
+    Args:
+    path: Path to the image
+    
+    Yields:
+    Tuple of ((height, width), read_crop) where read_crop(top, left, bottom, right) returns
+    the crop as a uint8 NumPy array of shape (height, width, channels)
+    """
+    if path.lower().endswith(WINDOWED_EXTENSIONS):
+        # rasterio is only needed for GeoTIFF inputs, so it is imported on first use
+        import rasterio
+        from rasterio.errors import NotGeoreferencedWarning
+        from rasterio.windows import Window
+        
+        # The COGs written by download_images.py carry no georeferencing
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', NotGeoreferencedWarning)
+            src = rasterio.open(path)
+        with src:
+            # Return RGB like the PIL branch: single-band (and band + alpha) images repeat
+            # band 1, while RGBA and multispectral images keep their first three bands
+            bands = [1, 2, 3] if src.count >= 3 else [1, 1, 1]
+            
+            def read_crop(top, left, bottom, right):
+                window = Window(left, top, right - left, bottom - top)
+                return src.read(bands, window=window).transpose(1, 2, 0)
+            
+            yield (src.height, src.width), read_crop
+    else:
+        # Decode once; every crop is a view into this array
+        with Image.open(path) as img:
+            image_array = np.asarray(img.convert('RGB'))
+        
+        def read_crop(top, left, bottom, right):
+            return image_array[top:bottom, left:right]
+        
+        yield image_array.shape[:2], read_crop
 
-def crop_image_pair(before_path, after_path, output_base, crop_size=256, max_attempts=100):
+def crop_image_pair(before_path, after_path, output_base, crop_size=256, max_attempts=None):
     """
     Crop a pair of before/after images and save the crops.
     
@@ -118,67 +137,168 @@ def crop_image_pair(before_path, after_path, output_base, crop_size=256, max_att
     after_path: Path to the 'after' image
     output_base: Base directory for saving cropped images
     crop_size: Size of the square crop
-    max_attempts: Maximum number of attempts to find a valid crop
+    max_attempts: Maximum number of candidate positions to try, defaults to all of them
     
     Returns:
     Path to the output folder if successful, None otherwise
     """
     try:
-        with Image.open(before_path) as before_img, Image.open(after_path) as after_img:
-            width, height = before_img.size
+        with open_crop_reader(before_path) as (size, read_before), open_crop_reader(after_path) as (_, read_after):
+            height, width = size
+            
+            # Allocate the output pair number once rather than per attempt
+            pair_number = get_next_pair_number(output_base)
             
-            for _ in range(max_attempts):
-                # Get a random bounding box
-                bbox = get_random_bounding_box((height, width), (crop_size, crop_size))
-                top, left, bottom, right = bbox_to_yx_np(bbox, (height, width))
+            # Try each grid position at most once, in random order
+            candidates = get_candidate_offsets((height, width), crop_size)
+            for top, left in candidates[:max_attempts]:
+                bottom, right = top + crop_size, left + crop_size
+                
+                before_tile = read_before(top, left, bottom, right)
+                after_tile = read_after(top, left, bottom, right)
                 
                 # Check if the crop is valid for both images
-                if is_valid_crop(before_img, (left, top, right, bottom)) and is_valid_crop(after_img, (left, top, right, bottom)):
-                    before_crop = before_img.crop((left, top, right, bottom))
-                    after_crop = after_img.crop((left, top, right, bottom))
+                if is_valid_crop(before_tile) and is_valid_crop(after_tile):
+                    before_crop = Image.fromarray(before_tile)
+                    after_crop = Image.fromarray(after_tile)
                     
                     # Create output folder
-                    pair_number = get_next_pair_number(output_base)
                     output_folder = os.path.join(output_base, f'pair_{pair_number}')
                     os.makedirs(output_folder, exist_ok=True)
                     
                     # Save cropped images
-                    before_filename = os.path.basename(before_path)
-                    after_filename = os.path.basename(after_path)
-                    before_crop.save(os.path.join(output_folder, f'before_{before_filename}'))
-                    after_crop.save(os.path.join(output_folder, f'after_{after_filename}'))
+                    before_filename = os.path.splitext(os.path.basename(before_path))[0] + '.jpg'
+                    after_filename = os.path.splitext(os.path.basename(after_path))[0] + '.jpg'
+                    before_crop.save(os.path.join(output_folder, f'before_{before_filename}'), 'JPEG', **JPEG_SAVE_OPTIONS)
+                    after_crop.save(os.path.join(output_folder, f'after_{after_filename}'), 'JPEG', **JPEG_SAVE_OPTIONS)
                     
                     print(f"Successfully cropped and saved images in {output_folder}.")
                     return output_folder
             
-            print("Failed to find a valid crop after maximum attempts.")
+            print("Failed to find a valid crop at any candidate position.")
             return None
     except Exception as e:
         print(f"Error processing images: {e}")
         return None
 
-def main():
-    # Set up command-line argument parsing
-    parser = argparse.ArgumentParser(description="Crop a pair of images from before and after an event.")
-    parser.add_argument("-d", "--disaster", required=True, help="Name of the disaster folder")
-    parser.add_argument("-l", "--location", required=True, help="Name of the location folder")
-    parser.add_argument("-s", "--size", type=int, default=256, help="Size of the square crop in pixels")
-    args = parser.parse_args()
-
+def crop_one(disaster, location, crop_size=256):
+    """
+    Crop one before/after pair for a single disaster and location.
+    
+    Returns:
+    Path to the output folder if successful, None otherwise
+    """
     # Get image pair
-    pairs = get_image_pairs(args.disaster, args.location)
+    pairs = get_image_pairs(disaster, location)
     
     if not pairs:
-        print("No suitable image pair found.")
-        return
+        print(f"No suitable image pair found for {disaster}/{location}.")
+        return None
 
     # Create output folder
-    output_base = os.path.join('cropped_images', args.disaster, args.location)
+    output_base = os.path.join('cropped_images', disaster, location)
     os.makedirs(output_base, exist_ok=True)
 
     # Crop and save the pair
     before_path, after_path = pairs[0]
-    output_folder = crop_image_pair(before_path, after_path, output_base, args.size)
+    return crop_image_pair(before_path, after_path, output_base, crop_size)
+
+def crop_one_task(task):
+    """Pool entry point: unpack a (disaster, location, crop_size) task for crop_one."""
+    disaster, location, crop_size = task
+    return disaster, location, crop_one(disaster, location, crop_size)
+
+def get_all_locations():
+    """
+    Find every (disaster, location) folder under images/.
+    """
+    locations = []
+    try:
+        with os.scandir('images') as disasters:
+            for disaster in disasters:
+                if disaster.is_dir():
+                    with os.scandir(disaster.path) as entries:
+                        locations.extend((disaster.name, entry.name) for entry in entries if entry.is_dir())
+    except FileNotFoundError:
+        print("No images directory found.")
+    return locations
+
+def read_manifest(manifest_path):
+    """
+    Read (disaster, location) pairs from a manifest file with one <disaster>/<location> per line.
+    
+    Raises:
+    ValueError if a non-blank line is not of the form <disaster>/<location>
+    """
+    locations = []
+    with open(manifest_path, 'r') as file:
+        for line_number, line in enumerate(file, 1):
+            line = line.strip()
+            if not line:
+                continue
+            disaster, _, location = line.partition('/')
+            if not (disaster and location):
+                raise ValueError(f"{manifest_path}:{line_number}: expected <disaster>/<location>, got '{line}'")
+            locations.append((disaster, location))
+    return locations
+
+def crop_all(crop_size=256, workers=None, locations=None):
+    """
+    Crop one pair for each location in parallel, in a single interpreter.
+    
+    Args:
+    crop_size: Size of the square crop
+    workers: Number of worker processes, defaults to CPU count
+    locations: List of (disaster, location) pairs, defaults to every location under images/
+    
+    Returns:
+    Number of locations cropped successfully
+    """
+    if locations is None:
+        locations = get_all_locations()
+    tasks = [(disaster, location, crop_size) for disaster, location in locations]
+    if not tasks:
+        print("No locations to crop.")
+        return 0
+    
+    # Register the image plugins once before the workers fork, rather than lazily in each worker
+    Image.preinit()
+    print(f"Cropping {len(tasks)} locations with {workers or os.cpu_count()} worker processes")
+    
+    successful = 0
+    with Pool(processes=workers) as pool:
+        for done, (disaster, location, output_folder) in enumerate(pool.imap_unordered(crop_one_task, tasks, chunksize=4), 1):
+            if output_folder:
+                successful += 1
+            print(f"[{done}/{len(tasks)}] {disaster}/{location}: {output_folder or 'failed'}")
+    
+    return successful
+
+def main():
+    # Set up command-line argument parsing
+    parser = argparse.ArgumentParser(description="Crop a pair of images from before and after an event.")
+    parser.add_argument("-d", "--disaster", help="Name of the disaster folder")
+    parser.add_argument("-l", "--location", help="Name of the location folder")
+    parser.add_argument("-s", "--size", type=int, default=256, help="Size of the square crop in pixels")
+    parser.add_argument("-a", "--all", action="store_true", help="Crop every location of every disaster found under images/")
+    parser.add_argument("-m", "--manifest", help="Path to a text file listing <disaster>/<location> folders to crop, one per line")
+    parser.add_argument("-w", "--workers", type=int, default=None, help="Number of worker processes for --all/--manifest. Defaults to CPU count")
+    args = parser.parse_args()
+
+    if args.all or args.manifest:
+        try:
+            locations = read_manifest(args.manifest) if args.manifest else None
+        except ValueError as e:
+            print(f"Invalid manifest: {e}")
+            return
+        successful = crop_all(args.size, args.workers, locations)
+        print(f"Processing completed. {successful} locations cropped successfully.")
+        return
+
+    if not (args.disaster and args.location):
+        parser.error("-d/--disaster and -l/--location are required unless --all or --manifest is given")
+
+    output_folder = crop_one(args.disaster, args.location, args.size)
 
     if output_folder:
         print(f"Processing completed. Results saved in: {output_folder}")
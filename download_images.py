@@ -1,66 +1,210 @@
 import argparse
+import asyncio
+import io
+import multiprocessing
 import os
-import requests
+import tempfile
+from contextlib import ExitStack
+import warnings
+import aiohttp
+import numpy as np
 from urllib.parse import urlparse
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from PIL import Image
-import io
+
+# libvips is optional: it shrinks JPEGs on load, but Pillow is used when it is unavailable
+try:
+    import pyvips
+except (ImportError, OSError):
+    pyvips = None
 
 Image.MAX_IMAGE_PIXELS = None
 
-def download_and_convert_file(url, base_output_dir, max_size=2048, quality=95):
-    try:
-        response = requests.get(url)
-        response.raise_for_status()
-        
-        relative_path = url.split("events/", 1)[1] if "events/" in url else urlparse(url).path.lstrip('/')
-        path_components = relative_path.split('/')
+CHUNK_SIZE = 1024 * 1024
+
+# Connection errors are retried with exponential backoff; HTTP error statuses are not
+MAX_RETRIES = 3
+BACKOFF_FACTOR = 0.3
+
+# Response bodies are staged here, under the output directory, rather than in the system
+# temp dir, which is often a small tmpfs that cannot hold many full-size images
+DOWNLOAD_TMP_DIR = '.download_tmp'
+
+# File extension for each supported output format
+OUTPUT_EXTENSIONS = {'jpeg': '.jpg', 'cog': '.tif'}
+
+def get_output_path(url, base_output_dir, output_format='jpeg'):
+    relative_path = url.split("events/", 1)[1] if "events/" in url else urlparse(url).path.lstrip('/')
+    path_components = relative_path.split('/')
+    
+    event_name = path_components[0]
+    location = '_'.join(path_components[1:4])
+    filename = '_'.join(path_components[4:])
+    filename = os.path.splitext(filename)[0] + OUTPUT_EXTENSIONS[output_format]
+    
+    output_dir = os.path.join(base_output_dir, "images", event_name, location)
+    os.makedirs(output_dir, exist_ok=True)
+    
+    return os.path.join(output_dir, filename)
+
+def encode_cog(img, quality=95):
+    # Tiled, JPEG-compressed Cloud-Optimized GeoTIFF so crops can be read window by window.
+    # rasterio is only needed for this format, so it is imported on first use
+    from rasterio.errors import NotGeoreferencedWarning
+    from rasterio.io import MemoryFile
+    
+    image_array = np.asarray(img).transpose(2, 0, 1)
+    # The output is a plain image tile set, not georeferenced
+    with warnings.catch_warnings(), MemoryFile() as memfile:
+        warnings.simplefilter('ignore', NotGeoreferencedWarning)
+        with memfile.open(driver='COG', width=img.width, height=img.height, count=image_array.shape[0],
+                          dtype='uint8', compress='JPEG', quality=quality) as dst:
+            dst.write(image_array)
+        return memfile.read()
+
+def convert_file_vips(source_path, max_size=2048, quality=95):
+    # libvips decodes JPEGs at a reduced scale when downsizing
+    thumb = pyvips.Image.thumbnail(source_path, max_size, size='down')
+    
+    # Convert to RGB if it's not already
+    if thumb.hasalpha():
+        thumb = thumb.flatten()
+    if thumb.interpretation != 'srgb':
+        thumb = thumb.colourspace('srgb')
+    
+    # Force 4:2:0 like the Pillow path; libvips otherwise disables subsampling at Q >= 90
+    return thumb.write_to_buffer('.jpg', Q=quality, subsample_mode='on', strip=True,
+                                 optimize_coding=False, interlace=False)
+
+def convert_file_pil(source_path, max_size=2048, quality=95, output_format='jpeg'):
+    with Image.open(source_path) as img:
+        # Let libjpeg decode at 1/2, 1/4 or 1/8 scale when that still covers max_size
+        img.draft('RGB', (max_size, max_size))
         
-        event_name = path_components[0]
-        location = '_'.join(path_components[1:4])
-        filename = '_'.join(path_components[4:])
-        filename = os.path.splitext(filename)[0] + '.jpg'
+        # Convert to RGB if it's not already
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
         
-        output_dir = os.path.join(base_output_dir, "images", event_name, location)
-        os.makedirs(output_dir, exist_ok=True)
+        # Resize the image if needed; bilinear is visually adequate for downscales of 4x or more
+        if max(img.size) > max_size:
+            resample = Image.BILINEAR if max(img.size) >= 4 * max_size else Image.LANCZOS
+            img.thumbnail((max_size, max_size), resample)
         
-        filepath = os.path.join(output_dir, filename)
+        if output_format == 'cog':
+            return encode_cog(img, quality)
         
-        # Open the image directly from the response content
-        with Image.open(io.BytesIO(response.content)) as img:
-            # Convert to RGB if it's not already
-            if img.mode != 'RGB':
-                img = img.convert('RGB')
+        # Encode as single-pass baseline JPEG with 4:2:0 subsampling
+        buffer = io.BytesIO()
+        img.save(buffer, 'JPEG', quality=quality, subsampling=2, optimize=False, progressive=False)
+        return buffer.getvalue()
+
+def convert_file(source_path, max_size=2048, quality=95, output_format='jpeg'):
+    """Decode, resize and re-encode a downloaded image; runs in a worker process and returns the encoded bytes."""
+    if pyvips is not None and output_format == 'jpeg':
+        return convert_file_vips(source_path, max_size, quality)
+    return convert_file_pil(source_path, max_size, quality, output_format)
+
+def write_file(filepath, data):
+    with open(filepath, 'wb') as file:
+        file.write(data)
+
+async def fetch_to_file(session, url, body, io_executor):
+    loop = asyncio.get_running_loop()
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            body.seek(0)
+            body.truncate()
             
-            # Resize the image
-            img.thumbnail((max_size, max_size), Image.LANCZOS)
+            # Stream the body in chunks instead of buffering the whole image as one bytes object
+            async with session.get(url) as response:
+                response.raise_for_status()
+                async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                    # Write from the I/O threads so disk writes never block the event loop
+                    await loop.run_in_executor(io_executor, body.write, chunk)
             
-            # Save as JPEG
-            img.save(filepath, 'JPEG', quality=quality)
+            body.seek(0)
+            return
+        except aiohttp.ClientResponseError:
+            raise
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            if attempt == MAX_RETRIES:
+                raise
+            await asyncio.sleep(BACKOFF_FACTOR * 2 ** attempt)
+
+async def download_and_convert_file(url, base_output_dir, session, semaphore, cpu_executor, io_executor,
+                                    max_size=2048, quality=95, output_format='jpeg'):
+    try:
+        async with semaphore:
+            # Stream the body to a temporary file rather than holding the whole image in memory
+            fd, body_path = tempfile.mkstemp(prefix='download_', dir=os.path.join(base_output_dir, DOWNLOAD_TMP_DIR))
+            try:
+                with os.fdopen(fd, 'w+b') as body:
+                    await fetch_to_file(session, url, body, io_executor)
+                
+                filepath = get_output_path(url, base_output_dir, output_format)
+                
+                # Decode, resize and encode in a worker process, then write from an I/O thread,
+                # so the event loop keeps downloading while earlier images are transcoded
+                loop = asyncio.get_running_loop()
+                data = await loop.run_in_executor(cpu_executor, convert_file, body_path, max_size, quality,
+                                                  output_format)
+                await loop.run_in_executor(io_executor, write_file, filepath, data)
+            finally:
+                os.remove(body_path)
         
         print(f"Downloaded and converted: {filepath}")
     except Exception as e:
         print(f"Error processing {url}: {str(e)}")
 
-def main():
+async def download_all(urls, base_output_dir, max_size=2048, quality=95, concurrency=64, output_format='jpeg',
+                       cpu_executor=None):
+    semaphore = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    tmp_dir = os.path.join(base_output_dir, DOWNLOAD_TMP_DIR)
+    os.makedirs(tmp_dir, exist_ok=True)
+    
+    with ExitStack() as stack:
+        # Callers that already run a process pool (process_disasters) pass it in so both
+        # stages share one CPU budget; otherwise start one for this run
+        if cpu_executor is None:
+            # Start the converter processes from a clean server process: forking this one would
+            # copy a running event loop and I/O threads into every child
+            start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            mp_context = multiprocessing.get_context(start_method)
+            cpu_executor = stack.enter_context(ProcessPoolExecutor(mp_context=mp_context))
+        io_executor = stack.enter_context(ThreadPoolExecutor())
+        async with aiohttp.ClientSession(connector=connector) as session:
+            await asyncio.gather(*(
+                download_and_convert_file(url, base_output_dir, session, semaphore, cpu_executor, io_executor,
+                                          max_size, quality, output_format)
+                for url in urls
+            ))
+    
+    # Every body file is removed after conversion, so the staging folder is empty by now
+    try:
+        os.rmdir(tmp_dir)
+    except OSError:
+        pass
+
+def main(links_file, base_output_dir, max_size=2048, quality=95, concurrency=64, output_format='jpeg',
+         cpu_executor=None):
+    with open(links_file, 'r') as file:
+        urls = [line.strip() for line in file if line.strip()]
+
+    asyncio.run(download_all(urls, base_output_dir, max_size, quality, concurrency, output_format, cpu_executor))
+
+    print(f"All downloads and conversions completed. Files saved in: {os.path.join(base_output_dir, 'images')}")
+
+if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Download and convert images from a list of URLs.")
     parser.add_argument("-l", "--links", required=True, help="Path to the text file containing URLs")
     parser.add_argument("-o", "--output", help="Path to the directory where images will be downloaded")
     parser.add_argument("-s", "--size", type=int, default=2048, help="Maximum size of the longest edge of the image (default: 2048)")
     parser.add_argument("-q", "--quality", type=int, default=95, help="JPEG quality (0-100, default: 95)")
+    parser.add_argument("-f", "--format", choices=sorted(OUTPUT_EXTENSIONS), default='jpeg', help="Output format: 'jpeg' or Cloud-Optimized GeoTIFF 'cog' (default: jpeg)")
+    parser.add_argument("-c", "--concurrency", type=int, default=64, help="Maximum number of downloads in flight (default: 64)")
     args = parser.parse_args()
 
     base_output_dir = args.output if args.output else os.path.dirname(os.path.abspath(__file__))
 
-    with open(args.links, 'r') as file:
-        urls = [line.strip() for line in file if line.strip()]
-
-    with ThreadPoolExecutor(max_workers=5) as executor:
-        futures = [executor.submit(download_and_convert_file, url, base_output_dir, args.size, args.quality) for url in urls]
-        for future in as_completed(futures):
-            future.result()
-
-    print(f"All downloads and conversions completed. Files saved in: {os.path.join(base_output_dir, 'images')}")
-
-if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main(args.links, base_output_dir, args.size, args.quality, args.concurrency, args.format)
\ No newline at end of file
@@ -1,60 +1,134 @@
 import argparse
+import logging
 import os
 import numpy as np
+from numba import njit, prange
 from PIL import Image
-import re
-import torch
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # Remove PIL image size limit to handle large satellite images
 Image.MAX_IMAGE_PIXELS = None
 
+# Fixed-quality baseline JPEG: 4:2:0 subsampling, no optimization or progressive passes
+JPEG_SAVE_OPTIONS = {'quality': 90, 'subsampling': 2, 'optimize': False, 'progressive': False}
+
 def get_image_pairs(disaster_folder, location_folder):
     """
     Find and return pairs of before/after images for a specific disaster and location.
     """
     base_path = os.path.join('images', disaster_folder, location_folder)
-    files = os.listdir(base_path)
-    
-    # Sort files by date
-    dated_files = []
-    for file in files:
-        # Use regex to extract date from filename
-        match = re.match(r'(\d{4}-\d{2}-\d{2})_(.+)', file)
-        if match:
-            date_str, _ = match.groups()
-            dated_files.append((date_str, file))
     
-    dated_files.sort(key=lambda x: x[0])  # Sort by date string
+    # Filenames start with a YYYY-MM-DD date, so plain string order is chronological
+    with os.scandir(base_path) as entries:
+        dated_files = [entry.name for entry in entries
+                       if len(entry.name) > 11 and entry.name[4] == '-' and entry.name[7] == '-' and entry.name[10] == '_']
     
     # Find pair of images (before and after)
     if len(dated_files) >= 2:
-        before_file = dated_files[0][1]  # Earliest date
-        after_file = dated_files[-1][1]  # Latest date
+        before_file = min(dated_files)  # Earliest date
+        after_file = max(dated_files)  # Latest date
         return [(os.path.join(base_path, before_file),
                  os.path.join(base_path, after_file))]
     
     return []
 
-def is_valid_crop(image, bbox, non_black_threshold=0.9):
+@njit(parallel=True, cache=True)
+def build_bright_value_table(image_array):
+    """
+    Build a summed-area table of the pixels brighter than 10% intensity in any channel.
+    
+    Args:
+    image_array: uint8 NumPy array of shape (height, width, channels)
+    
+    Returns:
+    int64 array of shape (height + 1, width + 1) where entry [y, x] is the number of
+    bright pixels in image_array[:y, :x]
+    """
+    height, width, channels = image_array.shape
+    table = np.zeros((height + 1, width + 1), dtype=np.int64)
+    
+    # Running sums along each row
+    for y in prange(height):
+        running = 0
+        for x in range(width):
+            for c in range(channels):
+                if image_array[y, x, c] > 25:
+                    running += 1
+                    break
+            table[y + 1, x + 1] = running
+    
+    # Running sums down each column
+    for x in prange(1, width + 1):
+        for y in range(1, height + 1):
+            table[y, x] += table[y - 1, x]
+    
+    return table
+
+@njit(parallel=True, cache=True)
+def tile_valid_mask(table, crop_size, threshold_count):
+    """
+    Look up the bright pixel count of every non-overlapping square tile in a summed-area table.
+    
+    Args:
+    table: Summed-area table from build_bright_value_table
+    crop_size: Size of the square tiles
+    threshold_count: Number of bright pixels a tile must exceed to be valid
+    
+    Returns:
+    Boolean array of shape (tile_rows, tile_cols) indicating which tiles are valid
+    """
+    tile_rows = (table.shape[0] - 1) // crop_size
+    tile_cols = (table.shape[1] - 1) // crop_size
+    mask = np.zeros((tile_rows, tile_cols), dtype=np.bool_)
+    
+    for row in prange(tile_rows):
+        y1 = row * crop_size
+        y2 = y1 + crop_size
+        for col in range(tile_cols):
+            x1 = col * crop_size
+            x2 = x1 + crop_size
+            count = table[y2, x2] - table[y1, x2] - table[y2, x1] + table[y1, x1]
+            mask[row, col] = count > threshold_count
+    
+    return mask
+
+def get_valid_tile_mask(image_array, crop_size, non_black_threshold=0.9):
     """
-    Check if the crop is not mostly black or not mostly white (clouds).
+    Check every non-overlapping square tile of an image at once for not being mostly black.
     
     Args:
-    image: PIL Image object
-    bbox: Tuple of (left, top, right, bottom)
+    image_array: uint8 NumPy array of the full image
+    crop_size: Size of the square tiles
     non_black_threshold: Minimum proportion of non-black pixels required
-    non_white_threshold: Minimum proportion of non-white pixels required
     
     Returns:
-    Boolean indicating if the crop is valid
+    Boolean array of shape (tile_rows, tile_cols) indicating which tiles are valid
     """
-    crop = image.crop(bbox)
-    crop_array = torch.tensor(np.array(crop)).float() / 255
-    non_black_pixels = torch.sum(crop_array > 0.1)  # Count pixels brighter than 10% intensity
-    total_pixels = crop_array.numel() / 3  # Divide by 3 for RGB channels
-    return (non_black_pixels / total_pixels) > non_black_threshold
+    if image_array.ndim == 2:
+        image_array = image_array[:, :, np.newaxis]
+    
+    table = build_bright_value_table(image_array)
+    threshold_count = non_black_threshold * crop_size * crop_size
+    return tile_valid_mask(table, crop_size, threshold_count)
 
-def process_image_pair(before_path, after_path, output_base, crop_size=256):
+def save_tile_pair(before_array, after_array, y, x, crop_size, output_folder, before_filename, after_filename):
+    """
+    Save one before/after tile pair cut from the decoded image arrays.
+    
+    Args:
+    before_array: uint8 NumPy array of the 'before' image
+    after_array: uint8 NumPy array of the 'after' image
+    y, x: Pixel coordinates of the top-left corner of the tile
+    crop_size: Size of the square crop
+    output_folder: Existing folder the pair is saved into
+    before_filename, after_filename: JPEG filenames, derived from the originals, used to name the crops
+    """
+    before_crop = Image.fromarray(before_array[y:y + crop_size, x:x + crop_size])
+    after_crop = Image.fromarray(after_array[y:y + crop_size, x:x + crop_size])
+    before_crop.save(os.path.join(output_folder, f'before_{before_filename}'), 'JPEG', **JPEG_SAVE_OPTIONS)
+    after_crop.save(os.path.join(output_folder, f'after_{after_filename}'), 'JPEG', **JPEG_SAVE_OPTIONS)
+
+def process_image_pair(before_path, after_path, output_base, crop_size=256, save_workers=None):
     """
     Process a pair of before/after images, extracting all possible squares of the specified size
     and saving only the valid pairs.
@@ -64,71 +138,100 @@ def process_image_pair(before_path, after_path, output_base, crop_size=256):
     after_path: Path to the 'after' image
     output_base: Base directory for saving cropped images
     crop_size: Size of the square crop
+    save_workers: Number of threads encoding crops; defaults to one per CPU
     
     Returns:
-    Number of valid crops saved
+    Number of valid crops saved, or None if the images could not be processed
     """
     try:
         with Image.open(before_path) as before_img, Image.open(after_path) as after_img:
-            width, height = before_img.size
+            # Decode both images once; every tile below is a view into these arrays
+            before_array = np.asarray(before_img, dtype=np.uint8)
+            after_array = np.asarray(after_img, dtype=np.uint8)
+            
+            # Validate all tiles of both images in one vectorized pass
+            before_mask = get_valid_tile_mask(before_array, crop_size)
+            after_mask = get_valid_tile_mask(after_array, crop_size)
+            rows = min(before_mask.shape[0], after_mask.shape[0])
+            cols = min(before_mask.shape[1], after_mask.shape[1])
+            valid_mask = before_mask[:rows, :cols] & after_mask[:rows, :cols]
+            
+            # Crops are always JPEG, whatever the source format (e.g. .tif COGs)
+            before_filename = os.path.splitext(os.path.basename(before_path))[0] + '.jpg'
+            after_filename = os.path.splitext(os.path.basename(after_path))[0] + '.jpg'
             
+            # Create all output folders up front so the save threads never race on mkdir
+            tiles = np.argwhere(valid_mask) * crop_size
+            output_folders = [os.path.join(output_base, f'pair_{i}') for i in range(len(tiles))]
+            for output_folder in output_folders:
+                os.makedirs(output_folder, exist_ok=True)
+            
+            # Encode and save the crops in parallel; PIL releases the GIL while encoding JPEGs
             valid_crops = 0
-            for y in range(0, height - crop_size + 1, crop_size):
-                for x in range(0, width - crop_size + 1, crop_size):
-                    bbox = (x, y, x + crop_size, y + crop_size)
+            failed_crops = 0
+            with ThreadPoolExecutor(max_workers=save_workers or os.cpu_count()) as executor:
+                futures = [executor.submit(save_tile_pair, before_array, after_array, y, x, crop_size,
+                                           output_folder, before_filename, after_filename)
+                           for (y, x), output_folder in zip(tiles, output_folders)]
+                for future in as_completed(futures):
+                    # One failed write should not discard the tiles already saved
+                    try:
+                        future.result()
+                    except Exception as e:
+                        failed_crops += 1
+                        logging.error(f"Error saving crop: {e}")
+                        continue
+                    valid_crops += 1
                     
-                    if is_valid_crop(before_img, bbox) and is_valid_crop(after_img, bbox):
-                        before_crop = before_img.crop(bbox)
-                        after_crop = after_img.crop(bbox)
-                        
-                        # Create output folder
-                        output_folder = os.path.join(output_base, f'pair_{valid_crops}')
-                        os.makedirs(output_folder, exist_ok=True)
-                        
-                        # Save cropped images
-                        before_filename = os.path.basename(before_path)
-                        after_filename = os.path.basename(after_path)
-                        before_crop.save(os.path.join(output_folder, f'before_{before_filename}'))
-                        after_crop.save(os.path.join(output_folder, f'after_{after_filename}'))
-                        
-                        valid_crops += 1
-                        
-                        if valid_crops % 100 == 0:
-                            print(f"Processed {valid_crops} valid crops...")
+                    if valid_crops % 100 == 0:
+                        logging.info(f"Processed {valid_crops} valid crops...")
             
-            print(f"Total valid crops saved: {valid_crops}")
+            if failed_crops:
+                logging.warning(f"{failed_crops} valid crops could not be saved")
+            logging.info(f"Total valid crops saved: {valid_crops}")
             return valid_crops
     except Exception as e:
-        print(f"Error processing images: {e}")
-        return 0
-
-def main():
-    # Set up command-line argument parsing
-    parser = argparse.ArgumentParser(description="Crop all valid squares from a pair of before/after event images.")
-    parser.add_argument("-d", "--disaster", required=True, help="Name of the disaster folder")
-    parser.add_argument("-l", "--location", required=True, help="Name of the location folder")
-    parser.add_argument("-s", "--size", type=int, default=256, help="Size of the square crop in pixels")
-    args = parser.parse_args()
+        logging.error(f"Error processing images: {e}")
+        return None
 
+def main(disaster, location, crop_size=256, save_workers=None):
+    """
+    Crop all valid tiles for one disaster and location.
+    
+    Returns:
+    Number of valid crops saved (0 when there is no dated pair or no valid tile),
+    or None if the images could not be processed
+    """
     # Get image pair
-    pairs = get_image_pairs(args.disaster, args.location)
+    pairs = get_image_pairs(disaster, location)
     
     if not pairs:
-        print("No suitable image pair found.")
-        return
+        logging.warning("No suitable image pair found.")
+        return 0
 
     # Create output folder
-    output_base = os.path.join('cropped_images', args.disaster, args.location)
+    output_base = os.path.join('cropped_images', disaster, location)
     os.makedirs(output_base, exist_ok=True)
 
     # Process and save all valid crops from the pair
     before_path, after_path = pairs[0]
-    total_crops = process_image_pair(before_path, after_path, output_base, args.size)
+    total_crops = process_image_pair(before_path, after_path, output_base, crop_size, save_workers)
 
-    if total_crops > 0:
-        print(f"Processing completed. {total_crops} valid crops saved in: {output_base}")
+    if total_crops is None:
+        logging.warning("Processing failed.")
+    elif total_crops > 0:
+        logging.info(f"Processing completed. {total_crops} valid crops saved in: {output_base}")
     else:
-        print("Processing failed or no valid crops found.")
+        logging.warning("No valid crops found.")
+    return total_crops
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    # Set up command-line argument parsing
+    parser = argparse.ArgumentParser(description="Crop all valid squares from a pair of before/after event images.")
+    parser.add_argument("-d", "--disaster", required=True, help="Name of the disaster folder")
+    parser.add_argument("-l", "--location", required=True, help="Name of the location folder")
+    parser.add_argument("-s", "--size", type=int, default=256, help="Size of the square crop in pixels")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    main(args.disaster, args.location, args.size)
\ No newline at end of file
@@ -1,34 +1,56 @@
 import sys
-import csv
 import requests
 import argparse
+import json
 import os
-from collections import defaultdict
+import time
+from functools import lru_cache
+import pandas as pd
 import leafmap
 
+COLLECTIONS_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'wuvision', 'maxar_collections.json')
+COLLECTIONS_CACHE_TTL = 3600  # seconds
+
+@lru_cache(maxsize=None)
+def get_maxar_collections():
+    """Return the Maxar disaster names, reusing an on-disk copy less than an hour old."""
+    try:
+        if time.time() - os.path.getmtime(COLLECTIONS_CACHE_PATH) < COLLECTIONS_CACHE_TTL:
+            with open(COLLECTIONS_CACHE_PATH) as f:
+                return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        pass
+    
+    collections = list(leafmap.maxar_collections())
+    try:
+        os.makedirs(os.path.dirname(COLLECTIONS_CACHE_PATH), exist_ok=True)
+        tmp_path = COLLECTIONS_CACHE_PATH + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(collections, f)
+        os.replace(tmp_path, COLLECTIONS_CACHE_PATH)
+    except OSError as e:
+        print(f"Could not cache disaster list: {e}")
+    return collections
+
 def get_disaster_data(disaster_name):
     url = f"https://raw.githubusercontent.com/opengeos/maxar-open-data/master/datasets/{disaster_name}.tsv"
-    response = requests.get(url)
-    if response.status_code != 200:
-        print(f"Failed to retrieve data for disaster: {disaster_name}")
-        sys.exit(1)
-    return response.text.splitlines()
+    with requests.get(url, stream=True) as response:
+        if response.status_code != 200:
+            print(f"Failed to retrieve data for disaster: {disaster_name}")
+            sys.exit(1)
+        # Parse the TSV straight from the response stream, keeping only the columns we filter on
+        response.raw.decode_content = True
+        return pd.read_csv(response.raw, sep='\t', usecols=['tile:clouds_percent', 'quadkey', 'visual'],
+                           dtype={'quadkey': str})
 
 def filter_images(disaster_data):
-    reader = csv.DictReader(disaster_data, delimiter='\t')
-    
-    valid_images = []
-    quadkey_count = defaultdict(int)
-    
-    for row in reader:
-        clouds_percent = float(row['tile:clouds_percent'])
-        if clouds_percent <= 15:
-            valid_images.append(row)
-            quadkey_count[row['quadkey']] += 1
+    valid_images = disaster_data[disaster_data['tile:clouds_percent'] <= 15]
     
-    filtered_images = [img for img in valid_images if quadkey_count[img['quadkey']] > 1]
+    # Keep only quadkeys with more than one valid image
+    quadkey_count = valid_images.groupby('quadkey')['visual'].transform('size')
+    filtered_images = valid_images[quadkey_count > 1]
     
-    return [img['visual'] for img in filtered_images]
+    return filtered_images['visual'].tolist()
 
 def save_links(links, disaster_name):
     folder_name = "filtered_links"
@@ -54,7 +76,7 @@ if __name__ == "__main__":
     disaster_name = args.disaster
 
     # Check if the disaster name is valid
-    valid_disasters = leafmap.maxar_collections()
+    valid_disasters = get_maxar_collections()
     if disaster_name not in valid_disasters:
         print(f"Error: '{disaster_name}' is not a valid disaster name.")
         print("Valid disaster names are:")
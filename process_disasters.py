@@ -1,126 +1,258 @@
 import argparse
-import subprocess
+import json
+import logging
+import logging.handlers
 import os
-import leafmap
+import statistics
+import sys
+import threading
 import time
-from multiprocessing import Pool, cpu_count
+import get_valid_links
+import download_images
+import get_all_valid_tiles
+import numba
+from collections import Counter
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import cpu_count
 import multiprocessing
 from datetime import datetime
 
+LOCATIONS_CACHE_PATH = os.path.join('.cache', 'locations.json')
+
+# Per-worker tile settings, set once by _init_worker instead of being pickled with every task
+CROP_SIZE = 256
+RESUME = False
+# Each pool process already has a core of its own, so keep its save threads few
+TILE_SAVE_WORKERS = 2
+
+DONE_MARKER = '.done'
+
 def run_get_valid_links(disaster):
-    """Run get_valid_links.py for a specific disaster."""
-    print(f"\nGetting valid links for disaster: {disaster}")
+    """Run get_valid_links for a specific disaster."""
+    logging.info(f"\nGetting valid links for disaster: {disaster}")
     try:
-        subprocess.run(['python', 'get_valid_links.py', '-d', disaster], check=True)
+        get_valid_links.main(disaster)
         return True
-    except subprocess.CalledProcessError as e:
-        print(f"Error getting links for {disaster}: {e}")
+    except (Exception, SystemExit) as e:
+        logging.error(f"Error getting links for {disaster}: {e}")
         return False
 
-def run_download_images(links_file, output_dir):
-    """Run download_images.py for a specific links file."""
-    print(f"\nDownloading images from: {links_file}")
+def run_download_images(links_file, output_dir, cpu_executor=None):
+    """Run download_images for a specific links file."""
+    logging.info(f"\nDownloading images from: {links_file}")
     try:
-        subprocess.run([
-            'python', 
-            'download_images.py', 
-            '-l', links_file,
-            '-o', output_dir
-        ], check=True)
+        download_images.main(links_file, output_dir, cpu_executor=cpu_executor)
         return True
-    except subprocess.CalledProcessError as e:
-        print(f"Error downloading images: {e}")
+    except Exception as e:
+        logging.error(f"Error downloading images: {e}")
         return False
 
+def _init_worker(crop_size, output_dir, resume=False, log_queue=None):
+    """Set the tile settings shared by every task in a worker process."""
+    global CROP_SIZE, RESUME
+    # Hand log records to the main process instead of writing to a shared stdout
+    if log_queue is not None:
+        root = logging.getLogger()
+        root.handlers = [logging.handlers.QueueHandler(log_queue)]
+        root.setLevel(logging.INFO)
+    CROP_SIZE = crop_size
+    RESUME = resume
+    # The pool already runs one process per core; numba's parallel kernels would
+    # otherwise start another thread per core inside every one of them
+    numba.set_num_threads(1)
+    # Resolve images/ and cropped_images/ against the run directory once per worker
+    os.chdir(output_dir)
+
 def run_get_all_valid_tiles(args):
-    """Run get_all_valid_tiles.py for a specific disaster and location."""
-    disaster, location, crop_size = args
+    """Run get_all_valid_tiles for a specific disaster and location."""
+    disaster, location = args
+    marker = os.path.join('cropped_images', disaster, location, DONE_MARKER)
+    if RESUME and os.path.exists(marker):
+        logging.info(f"\nSkipping {disaster}/{location}: tiles already done")
+        # No duration: a skipped location says nothing about how long its tiles take
+        return (disaster, location, True, None)
+    
+    start = time.perf_counter()
     try:
-        print(f"\nProcessing tiles for disaster: {disaster}, location: {location}")
-        subprocess.run([
-            'python',
-            'get_all_valid_tiles.py',
-            '-d', disaster,
-            '-l', location,
-            '-s', str(crop_size)
-        ], check=True)
-        return (disaster, location, True)
-    except subprocess.CalledProcessError as e:
-        print(f"Error processing tiles for {location}: {e}")
-        return (disaster, location, False)
+        logging.info(f"\nProcessing tiles for disaster: {disaster}, location: {location}")
+        # None means the images could not be processed; 0 crops is a finished location
+        success = get_all_valid_tiles.main(disaster, location, CROP_SIZE, TILE_SAVE_WORKERS) is not None
+        if success:
+            # Mark the location done only once all its tiles are written; the rename keeps
+            # an interrupted run from leaving a marker behind
+            os.makedirs(os.path.dirname(marker), exist_ok=True)
+            tmp_marker = marker + '.tmp'
+            with open(tmp_marker, 'w'):
+                pass
+            os.replace(tmp_marker, marker)
+    except Exception as e:
+        logging.error(f"Error processing tiles for {location}: {e}")
+        success = False
+    return (disaster, location, success, time.perf_counter() - start)
+
+@contextmanager
+def queue_logging(handler):
+    """Yield a queue for worker log records, drained through handler by one listener thread."""
+    log_queue = multiprocessing.Queue()
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    try:
+        yield log_queue
+    finally:
+        listener.stop()
+
+class TilePool(Executor):
+    """
+    The shared tile process pool, which can be replaced after a worker dies.
+    
+    A crashed worker (segfault, OOM kill) breaks a ProcessPoolExecutor for good; restart()
+    swaps in a fresh pool so the remaining locations can still run.
+    """
+
+    def __init__(self, start_pool):
+        self._start_pool = start_pool
+        self._lock = threading.Lock()
+        self._executor = start_pool()
+        self.restarts = 0
+
+    def submit(self, fn, /, *args, **kwargs):
+        with self._lock:
+            try:
+                return self._executor.submit(fn, *args, **kwargs)
+            except BrokenProcessPool as e:
+                # Report a broken pool through the future, like tasks that were already queued
+                future = Future()
+                future.set_exception(e)
+                return future
+
+    def restart(self):
+        with self._lock:
+            broken, self._executor = self._executor, self._start_pool()
+            self.restarts += 1
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        self._executor.shutdown(wait=wait, cancel_futures=cancel_futures)
 
 def get_locations_for_disaster(disaster):
     """Get all location folders for a specific disaster."""
     disaster_path = os.path.join('images', disaster)
-    if not os.path.exists(disaster_path):
-        print(f"No image directory found for disaster: {disaster}")
+    try:
+        with os.scandir(disaster_path) as entries:
+            return [entry.name for entry in entries if entry.is_dir()]
+    except FileNotFoundError:
+        logging.info(f"No image directory found for disaster: {disaster}")
         return []
-    return [d for d in os.listdir(disaster_path) if os.path.isdir(os.path.join(disaster_path, d))]
 
-def check_disaster_downloaded(disaster):
+class LocationsCache:
+    """Location folders per disaster, persisted between runs and re-scanned only when a disaster folder changes."""
+
+    def __init__(self, path=LOCATIONS_CACHE_PATH):
+        self.path = path
+        try:
+            with open(path) as f:
+                self.entries = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            self.entries = {}
+        if not isinstance(self.entries, dict):
+            self.entries = {}
+
+    def get(self, disaster):
+        """Return the locations for a disaster, using the cached list if the folder's mtime is unchanged."""
+        try:
+            mtime_ns = os.stat(os.path.join('images', disaster)).st_mtime_ns
+        except FileNotFoundError:
+            logging.info(f"No image directory found for disaster: {disaster}")
+            return []
+        
+        # Adding or removing a location folder bumps the disaster folder's mtime; an entry
+        # that does not have the expected shape is treated as a miss and rewritten
+        entry = self.entries.get(disaster)
+        if (isinstance(entry, dict) and entry.get('mtime_ns') == mtime_ns
+                and isinstance(entry.get('locations'), list)):
+            return entry['locations']
+        
+        locations = get_locations_for_disaster(disaster)
+        self.entries[disaster] = {'mtime_ns': mtime_ns, 'locations': locations}
+        return locations
+
+    def save(self):
+        """Write the cache atomically so an interrupted run never leaves a truncated file."""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.path)
+
+def normalize_disaster_name(name):
+    """Normalize a disaster name so folder names can be matched regardless of dashes and case."""
+    return name.replace("-", "").lower()
+
+def build_downloaded_index():
+    """Map normalized disaster names to the disaster folders that exist under images/."""
+    try:
+        with os.scandir('images') as entries:
+            return {normalize_disaster_name(entry.name): entry.name for entry in entries if entry.is_dir()}
+    except FileNotFoundError:
+        return {}
+
+def check_disaster_downloaded(disaster, downloaded_index, locations_cache):
     """Check if images for a disaster have already been downloaded."""
     # Normalize disaster name for comparison
-    disaster = disaster.replace("-", "").lower()
+    disaster = normalize_disaster_name(disaster)
     
-    # Check all directories in images folder
-    images_dir = 'images'
-    if not os.path.exists(images_dir):
-        return False
+    existing_dir = downloaded_index.get(disaster)
+    if existing_dir:
+        locations = locations_cache.get(existing_dir)
         
-    existing_dirs = os.listdir(images_dir)
-    
-    # Normalize existing directory names for comparison
-    for existing_dir in existing_dirs:
-        if existing_dir.replace("-", "").lower() == disaster:
-            disaster_path = os.path.join(images_dir, existing_dir)
-            locations = [d for d in os.listdir(disaster_path) 
-                        if os.path.isdir(os.path.join(disaster_path, d))]
-            
-            if locations:
-                print(f"\nFound existing downloads for {existing_dir} with {len(locations)} locations")
-                return True
+        if locations:
+            logging.info(f"\nFound existing downloads for {existing_dir} with {len(locations)} locations")
+            return True
     
-    print(f"\nNo existing downloads found for {disaster}")
+    logging.info(f"\nNo existing downloads found for {disaster}")
     return False
 
-def process_disaster_sequential(disaster, crop_size):
+def process_disaster_sequential(disaster, downloaded_index, locations_cache, cpu_executor=None):
     """Process a single disaster sequentially."""
     start_time = datetime.now()
-    print(f"\n{'='*80}")
-    print(f"Processing disaster: {disaster}")
-    print(f"Start time: {start_time}")
-    print(f"{'='*80}")
+    logging.info(f"\n{'='*80}")
+    logging.info(f"Processing disaster: {disaster}")
+    logging.info(f"Start time: {start_time}")
+    logging.info(f"{'='*80}")
     
     try:
         # Check if already downloaded
-        if not check_disaster_downloaded(disaster):
+        if not check_disaster_downloaded(disaster, downloaded_index, locations_cache):
             # Step 1: Get valid links
             links_file = os.path.join('filtered_links', f"{disaster}_filtered_images.txt")
             if not os.path.exists(links_file):
                 if not run_get_valid_links(disaster):
-                    print(f"Failed to get valid links for {disaster}")
+                    logging.error(f"Failed to get valid links for {disaster}")
                     return []
             else:
-                print(f"Using existing links file: {links_file}")
+                logging.info(f"Using existing links file: {links_file}")
             
             # Step 2: Download images
-            if not run_download_images(links_file, os.getcwd()):
-                print(f"Failed to download images for {disaster}")
+            if not run_download_images(links_file, os.getcwd(), cpu_executor):
+                logging.error(f"Failed to download images for {disaster}")
                 return []
         else:
-            print(f"Using existing downloads for {disaster}")
+            logging.info(f"Using existing downloads for {disaster}")
         
         # Step 3: Get locations
-        locations = get_locations_for_disaster(disaster)
+        locations = locations_cache.get(disaster)
+        locations_cache.save()
         if not locations:
-            print(f"No locations found for {disaster}")
+            logging.info(f"No locations found for {disaster}")
             return []
         
         # Return list of (disaster, location) tuples for parallel processing
-        return [(disaster, loc, crop_size) for loc in locations]
+        return [(disaster, loc) for loc in locations]
         
     except Exception as e:
-        print(f"Unexpected error processing disaster {disaster}: {e}")
+        logging.error(f"Unexpected error processing disaster {disaster}: {e}")
         return []
 
 def main():
@@ -128,69 +260,155 @@ def main():
     parser.add_argument("-d", "--disasters", nargs='+', help="List of disasters to process. If not specified, all available disasters will be processed.")
     parser.add_argument("-s", "--size", type=int, default=256, help="Size of the square crop in pixels")
     parser.add_argument("-w", "--workers", type=int, default=None, help="Number of worker processes to use. Defaults to CPU count - 1")
+    parser.add_argument("-y", "--yes", action="store_true", help="Start without waiting for confirmation")
+    parser.add_argument("-r", "--resume", action="store_true", help="Skip locations whose tiles were completed by an earlier run")
     args = parser.parse_args()
 
+    console = logging.StreamHandler(sys.stdout)
+    logging.basicConfig(level=logging.INFO, format='%(message)s', handlers=[console])
+
+    # Fork workers from a small forkserver process rather than from this one: it avoids
+    # inheriting the download stage's threads and executors (unsafe to fork), while the
+    # preloaded modules are imported once in the server instead of in every spawned worker.
+    # Workers still run this script as __mp_main__ to unpickle their tasks, so everything it
+    # imports is preloaded too; get_valid_links brings in leafmap, pandas and requests.
+    # ('__main__' alone is not enough: some Python versions silently skip it.)
+    if sys.platform.startswith('linux'):
+        multiprocessing.set_start_method('forkserver', force=True)
+        multiprocessing.set_forkserver_preload(['__main__', 'get_valid_links', 'leafmap',
+                                                'get_all_valid_tiles', 'download_images'])
+
     # Configure maximum workers
     max_workers = args.workers if args.workers is not None else max(1, cpu_count() - 1)
     
-    print(f"Using {max_workers} worker processes")
+    logging.info(f"Using {max_workers} worker processes")
     
     # Get list of disasters
-    available_disasters = leafmap.maxar_collections()
+    available_disasters = get_valid_links.get_maxar_collections()
     if args.disasters:
         disasters_to_process = [d for d in args.disasters if d in available_disasters]
         if not disasters_to_process:
-            print("No valid disasters specified.")
+            logging.info("No valid disasters specified.")
             return
     else:
         disasters_to_process = available_disasters
 
-    print(f"Will process the following disasters: {', '.join(disasters_to_process)}")
-    time.sleep(3)  # Give user time to read the list
+    logging.info(f"Will process the following disasters: {', '.join(disasters_to_process)}")
+    # Only pause for confirmation when someone is at the terminal to read the list
+    if sys.stdin.isatty() and not args.yes:
+        input("Press Enter to continue (or Ctrl-C to cancel)...")
 
-    overall_start_time = datetime.now()
-    print(f"\nStarting overall processing at: {overall_start_time}")
-    
-    # Process each disaster sequentially, but locations in parallel
-    all_location_tasks = []
-    for disaster in disasters_to_process:
-        location_tasks = process_disaster_sequential(disaster, args.size)
-        all_location_tasks.extend(location_tasks)
-    
-    if not all_location_tasks:
-        print("\nNo locations to process. Exiting.")
-        return
+    # Start the executors once, before any stage runs: disasters are prepared (links + download)
+    # on an I/O thread, and every location's tiles go to one shared process pool whose workers
+    # log through a queue that is only closed after the pool has shut down
+    with queue_logging(console) as log_queue, ThreadPoolExecutor(max_workers=1) as prep_executor, TilePool(
+            lambda: ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                                        initargs=(args.size, os.getcwd(), args.resume, log_queue))) as tile_executor:
+        overall_start_time = datetime.now()
+        logging.info(f"\nStarting overall processing at: {overall_start_time}")
         
-    print(f"\nProcessing {len(all_location_tasks)} total locations across all disasters")
-    
-    # Process all locations in parallel
-    successful_locations = 0
-    with Pool(processes=max_workers) as pool:
-        results = pool.map(run_get_all_valid_tiles, all_location_tasks)
+        # Scan images/ once for existing downloads instead of once per disaster
+        downloaded_index = build_downloaded_index()
+        locations_cache = LocationsCache()
         
-        # Count successful locations
-        successful_locations = sum(1 for _, _, success in results if success)
+        # Run the task graph: each finished preparation queues its locations' tile tasks
+        # straight away, so the pool never waits for the remaining disasters to download.
+        # Downloads convert their images on the tile pool too, so both stages share one CPU budget
+        prep_futures = {prep_executor.submit(process_disaster_sequential, disaster, downloaded_index,
+                                             locations_cache, tile_executor)
+                        for disaster in disasters_to_process}
+        pending = set(prep_futures)
+        tile_tasks = {}
+        total_locations = 0
+        results = []
+        successful_locations = 0
+        try:
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in prep_futures:
+                        for task in future.result():
+                            tile_future = tile_executor.submit(run_get_all_valid_tiles, task)
+                            tile_tasks[tile_future] = task
+                            pending.add(tile_future)
+                            total_locations += 1
+                        continue
+                    
+                    if future not in tile_tasks:
+                        # Already resubmitted to the restarted pool
+                        continue
+                    disaster, location = tile_tasks.pop(future)
+                    try:
+                        _, _, success, duration = future.result()
+                    except BrokenProcessPool as e:
+                        if not tile_executor.restarts:
+                            # A worker died (segfault, OOM kill). Restart the pool once and resubmit every
+                            # unfinished location. The crash came from one of the earliest unfinished tasks,
+                            # as those were the ones running, so they are queued last: a repeat crash then
+                            # only takes down the other suspects
+                            logging.error(f"A tile worker died ({e}); restarting the pool for the unfinished locations")
+                            tile_tasks[future] = (disaster, location)
+                            unfinished = [f for f in tile_tasks if not f.done() or f.exception() is not None]
+                            tile_executor.restart()
+                            for unfinished_future in unfinished[max_workers:] + unfinished[:max_workers]:
+                                task = tile_tasks.pop(unfinished_future)
+                                pending.discard(unfinished_future)
+                                tile_future = tile_executor.submit(run_get_all_valid_tiles, task)
+                                tile_tasks[tile_future] = task
+                                pending.add(tile_future)
+                            continue
+                        # The restarted pool broke as well; count the location as failed and keep going
+                        logging.error(f"Tile worker failed for {disaster}/{location}: {e}")
+                        success, duration = False, None
+                    results.append((disaster, location, success, duration))
+                    if success:
+                        successful_locations += 1
+                    logging.info(f"[{len(results)}/{total_locations}] {disaster}/{location}: {'done' if success else 'failed'} "
+                                 f"({successful_locations} successful so far)")
+        except BaseException:
+            # Don't wait for queued downloads and tile tasks when the run is aborted (e.g. Ctrl-C)
+            prep_executor.shutdown(wait=False, cancel_futures=True)
+            tile_executor.shutdown(wait=False, cancel_futures=True)
+            raise
+
+    # The summary is logged after the pool and listener have shut down, so no worker
+    # output is still queued behind it
+    if not total_locations:
+        logging.info("\nNo locations to process. Exiting.")
+        return
     
     overall_end_time = datetime.now()
     overall_duration = overall_end_time - overall_start_time
     
     # Print final results
-    print("\nProcessing completed!")
-    print(f"Successfully processed {successful_locations}/{len(all_location_tasks)} locations")
-    print(f"Total processing time: {overall_duration}")
+    logging.info("\nProcessing completed!")
+    logging.info(f"Successfully processed {successful_locations}/{total_locations} locations")
+    logging.info(f"Total processing time: {overall_duration}")
+    if successful_locations < total_locations:
+        logging.info("Re-run with --resume to retry only the locations that did not finish")
     
     # Print detailed results by disaster
-    print("\nDetailed results by disaster:")
-    disaster_results = {}
-    for disaster, location, success in results:
-        if disaster not in disaster_results:
-            disaster_results[disaster] = {"total": 0, "success": 0}
-        disaster_results[disaster]["total"] += 1
+    logging.info("\nDetailed results by disaster:")
+    totals = Counter()
+    successes = Counter()
+    for disaster, location, success, duration in results:
+        totals[disaster] += 1
         if success:
-            disaster_results[disaster]["success"] += 1
+            successes[disaster] += 1
+    
+    for disaster, total in totals.items():
+        logging.info(f"{disaster}: {successes[disaster]}/{total} locations successful")
     
-    for disaster, stats in disaster_results.items():
-        print(f"{disaster}: {stats['success']}/{stats['total']} locations successful")
+    # Per-location timings show which locations hold up the pool; skipped locations have none
+    timed_results = [result for result in results if result[3] is not None]
+    durations = [duration for _, _, _, duration in timed_results]
+    if len(durations) > 1:
+        cut_points = statistics.quantiles(durations, n=20, method="inclusive")
+        logging.info(f"\nTile time per location: p50 {cut_points[9]:.1f}s, p95 {cut_points[18]:.1f}s, max {max(durations):.1f}s")
+    if timed_results:
+        logging.info("Slowest locations:")
+        for disaster, location, success, duration in sorted(timed_results, key=lambda r: r[3], reverse=True)[:10]:
+            logging.info(f"  {disaster}/{location}: {duration:.1f}s{'' if success else ' (failed)'}")
 
 if __name__ == "__main__":
     # Required for Windows multiprocessing